@@ -1,4 +1,4 @@
-from functools import reduce
+from functools import cached_property, lru_cache
 from model_utils import Choices
 from buckaneer.product.exceptions import SequenceValidationException
 from buckaneer.product.utils import get_sequence_length_range
@@ -31,6 +31,15 @@ LINKAGES = ['o', 's']
 MODIFIERS = ['-', 'm', 'b']
 BACKBONES = ['r', 'd', 'm']
 IGNORED_CHARACTERS = [' ']  # these get removed from the sequence
+RNA_BASES_SET = frozenset(RNA_BASES)
+DNA_BASES_SET = frozenset(DNA_BASES)
+ALL_BASES_SET = RNA_BASES_SET | DNA_BASES_SET
+COMMON_BASES_SET = RNA_BASES_SET & DNA_BASES_SET
+RNA_ONLY_BASES_SET = RNA_BASES_SET - DNA_BASES_SET
+DNA_ONLY_BASES_SET = DNA_BASES_SET - RNA_BASES_SET
+LINKAGES_SET = frozenset(LINKAGES)
+MODIFIERS_SET = frozenset(MODIFIERS)
+BACKBONES_SET = frozenset(BACKBONES)
 MINIMUM_SEQUENCE_LENGTH = 10
 ULTRA_MOD_REQUIRED_SEQUENCE_LENGTH = 100
 
@@ -40,6 +49,35 @@ NUCLEOTIDE_ELEMENTS = Choices(
     ('backbone', 'BACKBONE', 'Backbone'),
     ('linkage', 'LINKAGE', 'Linkage'),
 )
+NUCLEOTIDE_ELEMENT_OFFSETS = {  # position of each element within a nucleotide in FLR
+    NUCLEOTIDE_ELEMENTS.MODIFIER: 0,
+    NUCLEOTIDE_ELEMENTS.BASE: 1,
+    NUCLEOTIDE_ELEMENTS.BACKBONE: 2,
+    NUCLEOTIDE_ELEMENTS.LINKAGE: 3,
+}
+
+ULTRA_MOD_BACKBONE_NUCLEOTIDES = frozenset([1, 2, 3, *range(29, 41), *range(69, 101)])
+ULTRA_MOD_LINKAGE_NUCLEOTIDES = frozenset([1, 2, 3, 97, 98, 99, 100])
+# (position, byte) pairs that ultra mod overwrites in a 100mer FLR sequence,
+# the last nucleotide has no linkage so it is left out
+_ULTRA_MOD_OVERLAY = tuple(
+    [((i - 1) * 4 + NUCLEOTIDE_ELEMENT_OFFSETS[NUCLEOTIDE_ELEMENTS.BACKBONE], ord('m'))
+     for i in ULTRA_MOD_BACKBONE_NUCLEOTIDES] +
+    [((i - 1) * 4 + NUCLEOTIDE_ELEMENT_OFFSETS[NUCLEOTIDE_ELEMENTS.LINKAGE], ord('s'))
+     for i in ULTRA_MOD_LINKAGE_NUCLEOTIDES if i < ULTRA_MOD_REQUIRED_SEQUENCE_LENGTH]
+)
+
+_VALIDATED_BASES = {
+    ENCODING_CHOICES.CUSTOM: ALL_BASES_SET,
+    ENCODING_CHOICES.DNA: DNA_BASES_SET,
+    ENCODING_CHOICES.RNA: RNA_BASES_SET
+}
+# byte strings of the allowed characters per sequence element, bytes.translate(None, delete) removes them
+# through a 256 entry lookup table so whatever is left over is invalid
+_VALIDATED_BASE_BYTES = {encoding: ''.join(bases).encode('ascii') for encoding, bases in _VALIDATED_BASES.items()}
+_MODIFIER_BYTES = ''.join(MODIFIERS).encode('ascii')
+_BACKBONE_BYTES = ''.join(BACKBONES).encode('ascii')
+_LINKAGE_BYTES = ''.join(LINKAGES).encode('ascii')
 
 SGRNA_SLR_SEQUENCE_SUFFIX = "GUUUUAGAGCUAGAAAUAGCAAGUUAAAAUAAGGCUAGUCCGUUAUCAACUUGAAAAAGUGGCACCGAGUCGGUGCUUUU"
 PRODUCT_SLR_SEQUENCE_SUFFIXES = {
@@ -87,9 +125,11 @@ def infer_encoding(raw_sequence: str) -> str:
     clean_raw_sequence = clean_sequence(raw_sequence)
     if clean_raw_sequence is None or clean_raw_sequence == '':
         return ENCODING_CHOICES.RNA
-    rna_base_count = reduce(lambda count, m: count + 1 if m in RNA_BASES else count, clean_raw_sequence.upper(), 0)
-    dna_base_count = reduce(lambda count, m: count + 1 if m in DNA_BASES else count, clean_raw_sequence.upper(), 0)
-    if dna_base_count == 0 and rna_base_count == 0:
+    upper_sequence = clean_raw_sequence.upper()
+    # bases shared by both encodings add to both counts, so only the encoding specific bases decide
+    rna_base_count = sum(upper_sequence.count(b) for b in RNA_ONLY_BASES_SET)
+    dna_base_count = sum(upper_sequence.count(b) for b in DNA_ONLY_BASES_SET)
+    if dna_base_count == 0 and rna_base_count == 0 and not any(b in upper_sequence for b in COMMON_BASES_SET):
         raise SequenceValidationException('Unable to determine encoding from sequence: {}'.format(clean_raw_sequence))
     elif dna_base_count > rna_base_count:
         return ENCODING_CHOICES.DNA
@@ -110,12 +150,12 @@ def infer_sequence_type(raw_sequence: str) -> str:
     clean_raw_sequence = clean_sequence(raw_sequence)
     if clean_raw_sequence is None or clean_raw_sequence == '':
         return SEQUENCE_TYPE_CHOICES.SINGLE_LETTER
-    modifier_count = reduce(lambda count, m: count + 1 if m in MODIFIERS else count, clean_raw_sequence.lower(), 0)
+    lower_sequence = clean_raw_sequence.lower()
+    modifier_count = sum(lower_sequence.count(m) for m in MODIFIERS)
     if modifier_count > 0:
         return SEQUENCE_TYPE_CHOICES.FOUR_LETTER
-    base_count = reduce(lambda count, b: count + 1 if b in set(DNA_BASES + RNA_BASES) else count, clean_raw_sequence.upper(), 0)
-    non_base_count = reduce(lambda count, b: count + 1 if b not in set(DNA_BASES + RNA_BASES) else count, clean_raw_sequence.upper(), 0)
-    if non_base_count > 0 or base_count == 0:
+    # the sequence is not empty here, so consisting only of bases also means it has at least one
+    if not ALL_BASES_SET.issuperset(clean_raw_sequence.upper()):
         raise SequenceValidationException('Unable to determine sequence_type from sequence: {}'.format(clean_raw_sequence))
     return SEQUENCE_TYPE_CHOICES.SINGLE_LETTER
 
@@ -130,60 +170,56 @@ def validate_sequence(raw_sequence: str, encoding: str, sequence_type: str, norm
 
 
 def validate_single_letter_sequence(raw_sequence: str, encoding: str, normalize: bool = True) -> str:
-    validated_bases = {
-        ENCODING_CHOICES.CUSTOM: set(RNA_BASES + DNA_BASES),
-        ENCODING_CHOICES.DNA: DNA_BASES,
-        ENCODING_CHOICES.RNA: RNA_BASES
-    }[encoding]
+    validated_bases = _VALIDATED_BASES[encoding]
     clean_raw_sequence = clean_sequence(raw_sequence)
     if len(clean_raw_sequence) < MINIMUM_SEQUENCE_LENGTH:
         raise SequenceValidationException('Sequence length is {} and is below minimum of {}'.format(
             len(clean_raw_sequence), MINIMUM_SEQUENCE_LENGTH))
-    sequence = ""
+    upper_sequence = clean_raw_sequence.upper()
+    if not upper_sequence.isascii() or upper_sequence.encode('ascii').translate(None, _VALIDATED_BASE_BYTES[encoding]):
+        # only walk the sequence by hand to report the first offending base
+        i, c = next((i, c) for i, c in enumerate(clean_raw_sequence) if c.upper() not in validated_bases)
+        raise SequenceValidationException("Invalid base '{}' found at position {}".format(c, i))
+    return upper_sequence if normalize else clean_raw_sequence
+
+
+def _invalid_four_letter_element(clean_raw_sequence: str, validated_bases: frozenset) -> SequenceValidationException:
     for i, c in enumerate(clean_raw_sequence):
-        if c.upper() in validated_bases:
-            sequence += c.upper() if normalize else c
-        else:
-            raise SequenceValidationException("Invalid base '{}' found at position {}".format(c, i))
-    return sequence
+        if i % 4 == 0 and c.lower() not in MODIFIERS_SET:
+            return SequenceValidationException("Invalid modifier '{}' found at position {}".format(c, i))
+        elif i % 4 == 1 and c.upper() not in validated_bases:
+            return SequenceValidationException("Invalid base '{}' found at position {}".format(c, i))
+        elif i % 4 == 2 and c.lower() not in BACKBONES_SET:
+            return SequenceValidationException("Invalid backbone '{}' found at position {}".format(c, i))
+        elif i % 4 == 3 and c.lower() not in LINKAGES_SET:
+            return SequenceValidationException("Invalid linkage '{}' found at position {}".format(c, i))
 
 
 def validate_four_letter_sequence(raw_sequence: str, encoding: str, normalize: bool = True) -> str:
-    validated_bases = {
-        ENCODING_CHOICES.CUSTOM: set(RNA_BASES + DNA_BASES),
-        ENCODING_CHOICES.DNA: DNA_BASES,
-        ENCODING_CHOICES.RNA: RNA_BASES
-    }[encoding]
+    validated_bases = _VALIDATED_BASES[encoding]
     clean_raw_sequence = clean_sequence(raw_sequence)
-    modifier_count = reduce(lambda count, m: count + 1 if m in MODIFIERS else count, clean_raw_sequence.lower(), 0)
-    if modifier_count > 0 and clean_raw_sequence[0].lower() not in MODIFIERS:
+    lower_sequence = clean_raw_sequence.lower()
+    modifier_count = sum(lower_sequence.count(m) for m in MODIFIERS)
+    if modifier_count > 0 and lower_sequence[0] not in MODIFIERS_SET:
         raise SequenceValidationException("Modifier is missing at start of sequence")  # common excel error
-    sequence = ""
-    base_count = 0
-    for i, c in enumerate(clean_raw_sequence):
-        if i % 4 == 0:
-            if c.lower() not in MODIFIERS:
-                raise SequenceValidationException("Invalid modifier '{}' found at position {}".format(c, i))
-            sequence += c.lower() if normalize else c
-        elif i % 4 == 1:
-            if c.upper() not in validated_bases:
-                raise SequenceValidationException("Invalid base '{}' found at position {}".format(c, i))
-            sequence += c.upper() if normalize else c
-            base_count += 1
-        elif i % 4 == 2:
-            if c.lower() not in BACKBONES:
-                raise SequenceValidationException("Invalid backbone '{}' found at position {}".format(c, i))
-            sequence += c.lower() if normalize else c
-        elif i % 4 == 3:
-            if c.lower() not in LINKAGES:
-                raise SequenceValidationException("Invalid linkage '{}' found at position {}".format(c, i))
-            sequence += c.lower() if normalize else c
-        if (i + 1) == len(clean_raw_sequence) and i % 4 != 2:
-            raise SequenceValidationException("Linkage found at end of sequence]")
+    if not clean_raw_sequence.isascii():  # every valid FLR character is ascii
+        raise _invalid_four_letter_element(clean_raw_sequence, validated_bases)
+    lower_bytes = lower_sequence.encode('ascii')
+    bases = clean_raw_sequence[1::4].upper().encode('ascii')
+    if (lower_bytes[0::4].translate(None, _MODIFIER_BYTES) or bases.translate(None, _VALIDATED_BASE_BYTES[encoding])
+            or lower_bytes[2::4].translate(None, _BACKBONE_BYTES) or lower_bytes[3::4].translate(None, _LINKAGE_BYTES)):
+        raise _invalid_four_letter_element(clean_raw_sequence, validated_bases)
+    if clean_raw_sequence and len(clean_raw_sequence) % 4 != 3:
+        raise SequenceValidationException("Linkage found at end of sequence]")
+    base_count = len(bases)
     if base_count < MINIMUM_SEQUENCE_LENGTH:
         raise SequenceValidationException('Sequence length is {} and is below minimum of {}'.format(
             base_count, MINIMUM_SEQUENCE_LENGTH))
-    return sequence
+    if not normalize:
+        return clean_raw_sequence
+    sequence = bytearray(lower_bytes)
+    sequence[1::4] = bases
+    return sequence.decode('ascii')
 
 
 #######
@@ -191,33 +227,33 @@ def validate_four_letter_sequence(raw_sequence: str, encoding: str, normalize: b
 #######
 
 
+@lru_cache(maxsize=None)
+def standard_mod_nucleotides(sequence_length: int) -> frozenset:
+    # first three and last three nucleotides, shared between calls for the same length
+    return frozenset([1, 2, 3, sequence_length - 2, sequence_length - 1, sequence_length])
+
+
 def modify_four_letter_sequence(four_letter_sequence: str, modification_type: str, nucleotide_index_array: list, modification: str) -> str:
-    cleaned_sequence = clean_sequence(four_letter_sequence)
-    sequence = ''
-    nucleotide_index = 1
-    for i, c in enumerate(cleaned_sequence):
-        if i % 4 == 0:
-            if modification_type == NUCLEOTIDE_ELEMENTS.MODIFIER and nucleotide_index in nucleotide_index_array:
-                sequence += modification
-            else:    
-                sequence += c
-        elif i % 4 == 1:
-            if modification_type == NUCLEOTIDE_ELEMENTS.BASE and nucleotide_index in nucleotide_index_array:
-                sequence += modification
-            else:    
-                sequence += c
-        elif i % 4 == 2:
-            if modification_type == NUCLEOTIDE_ELEMENTS.BACKBONE and nucleotide_index in nucleotide_index_array:
-                sequence += modification
-            else:    
-                sequence += c
-        elif i % 4 == 3:
-            if modification_type == NUCLEOTIDE_ELEMENTS.LINKAGE and nucleotide_index in nucleotide_index_array:
-                sequence += modification
-            else:    
-                sequence += c
-            nucleotide_index += 1
-    return sequence
+    return modify_four_letter_sequence_multi(four_letter_sequence, {modification_type: (nucleotide_index_array, modification)})
+
+
+def modify_four_letter_sequence_multi(four_letter_sequence: str, replacements: dict) -> str:
+    """
+    Applies modifications to several nucleotide elements of an FLR sequence at once, only the targeted positions are rewritten,
+    replacements maps the element type to a (nucleotide_index_array, modification) pair, eg
+    {NUCLEOTIDE_ELEMENTS.BACKBONE: ([1, 2, 3], 'm'), NUCLEOTIDE_ELEMENTS.LINKAGE: ([1, 2, 3], 's')}
+    """
+    sequence = bytearray(clean_sequence(four_letter_sequence), 'ascii')  # FLR is pure ascii, so edit the bytes in place
+    for modification_type, (nucleotide_index_array, modification) in replacements.items():
+        if modification_type not in NUCLEOTIDE_ELEMENT_OFFSETS:
+            continue
+        offset = NUCLEOTIDE_ELEMENT_OFFSETS[modification_type]
+        value = ord(modification)
+        for nucleotide_index in nucleotide_index_array:
+            i = (nucleotide_index - 1) * 4 + offset
+            if 0 <= i < len(sequence):
+                sequence[i] = value
+    return sequence.decode('ascii')
 
 
 ############
@@ -266,6 +302,9 @@ class Sequence(object):
     product can be optionally provided to this class,
     some synthego products append a sequence suffix to the customer sequence, see PRODUCT_SLR_SEQUENCE_SUFFIXES
     in this case, the customer sequence must be provided in SLR, so both sequences can be concatenated
+
+    Derived attributes (four_letter_representation, mass, sequence_length, sequence_length_range)
+    are computed once and cached, so changing raw_sequence, modification or product after init is not supported
     """
 
     def __init__(self, 
@@ -276,9 +315,17 @@ class Sequence(object):
         label: str = None,
         product: object = None
     ):
+        self._setup(raw_sequence, encoding, sequence_type, modification, label, product)
+
+    def _setup(self, raw_sequence: str, encoding: str, sequence_type: str, modification: str, label: str, product: object,
+               trusted: bool = False) -> None:
         self.sequence_type = validate_sequence_type(sequence_type) if sequence_type else infer_sequence_type(raw_sequence)
         self.encoding = validate_encoding(encoding) if encoding else infer_encoding(raw_sequence)
-        self.raw_sequence = validate_sequence(raw_sequence, self.encoding, self.sequence_type)
+        if trusted and raw_sequence is not None and raw_sequence.strip() != '':
+            # sequences stored by to_json were validated and normalized before they were written
+            self.raw_sequence = clean_sequence(raw_sequence)
+        else:
+            self.raw_sequence = validate_sequence(raw_sequence, self.encoding, self.sequence_type)
         self.label = label
         self.product = product
         self.set_product_sequence()
@@ -292,7 +339,7 @@ class Sequence(object):
             self.chemistry_object = ChemistrySequence.new(three_letter_representation=self.raw_sequence or self.product_sequence)
         self.modification = validate_modification(modification, self.sequence_length)
 
-    @property
+    @cached_property
     def four_letter_representation(self) -> str:
         if self.modified:
             return Sequence.modify(self.chemistry_object.three_letter_representation, self.modification)
@@ -302,18 +349,24 @@ class Sequence(object):
     @classmethod
     def from_json(cls, data: object, product=None) -> object:
         try:
-            return cls(
+            # json written before the modification was stored only has the modified flag, which meant standard
+            modification = data.get('modification') or (
+                MODIFICATION_CHOICES.STANDARD if data['modified'] else MODIFICATION_CHOICES.NONE)
+            sequence = cls.__new__(cls)
+            sequence._setup(
                 raw_sequence=data['customer_sequence'],
                 encoding=data['sequence_encoding'],
                 sequence_type=data['sequence_type'],
-                modified=data['modified'],
+                modification=modification,
                 label=data['customer_label'],
-                product=product
+                product=product,
+                trusted=True
             )
+            return sequence
         except KeyError as e:
             raise SequenceValidationException('Unable to load sequence from json, missing key {} in {}'.format(e, data))
 
-    @property
+    @cached_property
     def mass(self) -> int:
         return int(self.chemistry_object.mass)
 
@@ -323,8 +376,8 @@ class Sequence(object):
 
     @classmethod
     def modify(cls, four_letter_sequence: str, modification: str) -> str:
-        modified_sequence = validate_four_letter_sequence(four_letter_sequence)
-        sequence_length = ChemistrySequence.new(three_letter_representation=modified_sequence).length
+        modified_sequence = validate_four_letter_sequence(four_letter_sequence, ENCODING_CHOICES.CUSTOM)
+        sequence_length = (len(modified_sequence) + 1) // 4  # validated FLR has one base every 4 characters
         if modification == MODIFICATION_CHOICES.STANDARD:
             """
             Changes the backbone and linkage for the first three and last three bases of an FLR sequence,
@@ -333,18 +386,11 @@ class Sequence(object):
             to
             '-Gms-Ams-Ums-Uro-Ams-Cms-Am'
             """
-            modified_sequence = modify_four_letter_sequence(
-                modified_sequence, 
-                NUCLEOTIDE_ELEMENTS.BACKBONE, 
-                [1, 2, 3, sequence_length - 2, sequence_length - 1, sequence_length],
-                'm'
-            )
-            modified_sequence = modify_four_letter_sequence(
-                modified_sequence, 
-                NUCLEOTIDE_ELEMENTS.LINKAGE, 
-                [1, 2, 3, sequence_length - 2, sequence_length - 1, sequence_length],
-                's'
-            )
+            nucleotide_index_array = standard_mod_nucleotides(sequence_length)
+            modified_sequence = modify_four_letter_sequence_multi(modified_sequence, {
+                NUCLEOTIDE_ELEMENTS.BACKBONE: (nucleotide_index_array, 'm'),
+                NUCLEOTIDE_ELEMENTS.LINKAGE: (nucleotide_index_array, 's'),
+            })
         elif modification == MODIFICATION_CHOICES.ULTRA:
             """
             Sample result:
@@ -353,25 +399,17 @@ class Sequence(object):
             if sequence_length != ULTRA_MOD_REQUIRED_SEQUENCE_LENGTH:
                 raise SequenceValidationException('Ultra mod is only supported for {}mers, sequence length is {}'.format(
                     ULTRA_MOD_REQUIRED_SEQUENCE_LENGTH, sequence_length))
-            modified_sequence = modify_four_letter_sequence(
-                modified_sequence, 
-                NUCLEOTIDE_ELEMENTS.BACKBONE, 
-                [1, 2, 3, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 69, 70, 71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100],
-                'm'
-            )
-            modified_sequence = modify_four_letter_sequence(
-                modified_sequence, 
-                NUCLEOTIDE_ELEMENTS.LINKAGE, 
-                [1, 2, 3, 97, 98, 99, 100],
-                's'
-            )
+            sequence = bytearray(modified_sequence, 'ascii')
+            for i, value in _ULTRA_MOD_OVERLAY:
+                sequence[i] = value
+            modified_sequence = sequence.decode('ascii')
         return modified_sequence
 
-    @property
+    @cached_property
     def sequence_length(self) -> int:
         return self.chemistry_object.length
 
-    @property
+    @cached_property
     def sequence_length_range(self) -> str:
         return get_sequence_length_range(self.sequence_length)
 
@@ -389,6 +427,7 @@ class Sequence(object):
             'customer_label': self.label,
             'customer_sequence': self.raw_sequence,
             'four_letter_sequence': self.four_letter_representation,
+            'modification': self.modification,
             'modified': self.modified,
             'product_sequence': self.product_sequence,
             'sequence_encoding': self.encoding,